@@ -1,4 +1,5 @@
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 import shutil
 import sys
 import os
@@ -14,16 +15,22 @@ from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm, trange
 
 import argparse
+import hashlib
+import inspect
+import json
 import logging
 import random
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from torch.nn import CrossEntropyLoss, MSELoss, BCEWithLogitsLoss
+from torch.nn.utils.rnn import pack_padded_sequence
+from torch.optim import AdamW
+from torch.optim.lr_scheduler import LambdaLR
 
 from pytorch_transformers import BertModel, BasicTokenizer
-from pytorch_transformers import AdamW, WarmupLinearSchedule
 from pytorch_transformers.modeling_bert import BertEncoder
 from torch.utils.data import (
     DataLoader,
@@ -41,7 +48,11 @@ from utils_sec import (
     output_modes,
     processors,
     convert_examples_to_features_sec,
+    convert_features_to_arrays_sec,
+    collate_sec_paragraphs,
+    collate_sec_encoded_paragraphs,
     SECDataset,
+    SECEncodedDataset,
 )
 
 logger = logging.getLogger(__name__)
@@ -64,6 +75,16 @@ def get_curr_alpha(step, t_total):
     # return max(0.0, float(t_total - step) / float(max(1.0, t_total)))
 
 
+def get_linear_schedule_with_warmup(optimizer, warmup_steps, t_total):
+    # Same schedule as WarmupLinearSchedule from pytorch_transformers
+    def lr_lambda(step):
+        if step < warmup_steps:
+            return float(step) / float(max(1, warmup_steps))
+        return max(0.0, float(t_total - step) / float(max(1.0, t_total - warmup_steps)))
+
+    return LambdaLR(optimizer, lr_lambda)
+
+
 class RNNModel(nn.Module):
     def __init__(self, args):
         super(RNNModel, self).__init__()
@@ -121,22 +142,19 @@ class RNNModel(nn.Module):
                 nn.Linear(64, self.num_classes),
             )
 
-    def forward(self, x):
-        # Set initial hidden and cell states
-        h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(
-            self.args.device
-        )
-        c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(
-            self.args.device
-        )
+    def forward(self, x, lengths=None):
+        # Skip the padded paragraphs of shorter filings in the batch
+        if lengths is not None:
+            x = pack_padded_sequence(
+                x, lengths.cpu(), batch_first=True, enforce_sorted=False
+            )
 
-        # Forward propagate LSTM
-        out, _ = self.lstm(
-            x, (h0, c0)
-        )  # out: tensor of shape (batch_size, seq_length, hidden_size)
+        # Forward propagate LSTM, the initial hidden and cell states default to zeros
+        # h_n: tensor of shape (num_layers, batch_size, hidden_size)
+        _, (h_n, _) = self.lstm(x)
 
-        # Decode the hidden state of the last time step
-        out = self.linear_layers(out[:, -1, :])
+        # Decode the hidden state of the last (non-padded) time step
+        out = self.linear_layers(h_n[-1])
         return out
 
     def save_pretrained(self, save_directory):
@@ -221,9 +239,18 @@ class PretrainedModel(nn.Module):
         )
         self.config = self.model.config
         self.config.freeze_adapter = args.freeze_adapter
+        self.is_half = False
         if not args.grouped_params:
             for p in self.parameters():
                 p.requires_grad = False
+            # The frozen FinBERT is only used as a feature extractor (in half precision
+            # on GPU only, torch has no Half CPU kernels for addmm and LayerNorm)
+            if args.fp16 and args.device.type == "cuda":
+                self.model.half()
+                self.is_half = True
+            self.model.eval()
+        elif args.gradient_checkpointing:
+            self.model.encoder.gradient_checkpointing = True
 
     def forward(
         self,
@@ -243,6 +270,14 @@ class PretrainedModel(nn.Module):
             head_mask=head_mask,
         )
 
+        # Outside of autocast the next modules expect float32 features
+        if self.is_half and not torch.is_autocast_enabled():
+            outputs = (
+                outputs[0].float(),
+                outputs[1].float(),
+                tuple(hidden_state.float() for hidden_state in outputs[2]),
+            ) + outputs[3:]
+
         return outputs  # (loss), logits, (hidden_states), (attentions)
 
     def save_pretrained(self, save_directory):
@@ -471,6 +506,49 @@ class AdapterEnsembleModel(nn.Module):
         logger.info("Saving model checkpoint to %s", save_directory)
 
 
+class PretrainedAdapterEnsembleModel(nn.Module):
+    """FinBERT followed by the adapter ensemble as a single module.
+
+    Used for the forward pass only (one call per paragraph chunk and one graph for
+    torch.compile), both models are still optimized and saved on their own.
+    """
+
+    def __init__(self, pretrained_model, adapter_ensemble_model):
+        super(PretrainedAdapterEnsembleModel, self).__init__()
+        self.pretrained_model = pretrained_model
+        self.adapter_ensemble_model = adapter_ensemble_model
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None):
+        pretrained_model_outputs = self.pretrained_model(
+            input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids
+        )
+        return self.adapter_ensemble_model(
+            pretrained_model_outputs,
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+        )
+
+
+def compile_model(model):
+    # Compile only the forward so that the state dict keys of the model stay the same
+    model.forward = torch.compile(
+        model.forward, mode="reduce-overhead", fullgraph=False
+    )
+    return model
+
+
+# The arrays of `convert_features_to_arrays_sec`, one .npy file each in the cache dir
+FEATURES_ARRAY_NAMES = (
+    "input_ids",
+    "input_mask",
+    "segment_ids",
+    "num_paragraphs",
+    "kpi_features",
+    "label_ids",
+)
+
+
 def load_and_cache_examples(args, task, tokenizer, dataset_type, evaluate=False):
     # Modify for our dataset
     # dataset_type: train, dev, test
@@ -480,11 +558,11 @@ def load_and_cache_examples(args, task, tokenizer, dataset_type, evaluate=False)
     processor = processors[task]()
     output_mode = output_modes[task]
     # Load data features from cache or dataset file
-    cached_features_file = os.path.join(
+    cached_features_dir = os.path.join(
         args.data_dir,
-        "cached_{}_{}_{}_{}_{}_{}".format(
+        "cached_{}_{}_{}_{}_{}_{}_arrays".format(
             dataset_type,
-            list(filter(None, args.finbert_path.split("/"))).pop(),
+            os.path.basename(os.path.normpath(args.finbert_path)),
             str(args.max_seq_length),
             str(task),
             str(args.percentage_change_type),
@@ -492,9 +570,15 @@ def load_and_cache_examples(args, task, tokenizer, dataset_type, evaluate=False)
         ),
     )
     # Remove "not" when finished with development
-    if os.path.exists(cached_features_file):
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features = torch.load(cached_features_file)
+    if os.path.exists(cached_features_dir):
+        logger.info("Loading features from cached dir %s", cached_features_dir)
+        # Memory-map the arrays (copy-on-write) instead of reading them into memory
+        features_arrays = {
+            name: np.load(
+                os.path.join(cached_features_dir, name + ".npy"), mmap_mode="c"
+            )
+            for name in FEATURES_ARRAY_NAMES
+        }
     else:
         logger.info("Creating features from dataset file at %s", args.data_dir)
         examples = (
@@ -525,45 +609,312 @@ def load_and_cache_examples(args, task, tokenizer, dataset_type, evaluate=False)
             pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
             pad_token_segment_id=0,
         )
+        features_arrays = convert_features_to_arrays_sec(features, args.max_seq_length)
         if args.local_rank in [-1, 0]:
-            logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save(features, cached_features_file)
+            logger.info("Saving features into cached dir %s", cached_features_dir)
+            # Write into a temporary dir and only move it into place once all arrays
+            # are saved, so an interrupted save is never taken for a valid cache
+            tmp_cached_features_dir = "{}.tmp-{}".format(
+                cached_features_dir, os.getpid()
+            )
+            os.makedirs(tmp_cached_features_dir, exist_ok=True)
+            try:
+                for name in FEATURES_ARRAY_NAMES:
+                    np.save(
+                        os.path.join(tmp_cached_features_dir, name + ".npy"),
+                        features_arrays[name],
+                    )
+                try:
+                    os.rename(tmp_cached_features_dir, cached_features_dir)
+                except OSError:
+                    # Another run sharing the data dir saved the same cache first
+                    if not os.path.exists(cached_features_dir):
+                        raise
+                    logger.info(
+                        "Cached dir %s already saved by another run",
+                        cached_features_dir,
+                    )
+            finally:
+                if os.path.exists(tmp_cached_features_dir):
+                    shutil.rmtree(tmp_cached_features_dir, ignore_errors=True)
 
     if args.local_rank == 0 and not evaluate:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
+    # Convert to Tensors (sharing the memory of the arrays) and build dataset
+    dataset = SECDataset(
+        torch.from_numpy(features_arrays["input_ids"]),
+        torch.from_numpy(features_arrays["input_mask"]),
+        torch.from_numpy(features_arrays["segment_ids"]),
+        torch.from_numpy(features_arrays["num_paragraphs"]),
+        torch.from_numpy(features_arrays["kpi_features"]),
+        torch.from_numpy(features_arrays["label_ids"]),
+    )
 
-    # Convert input ids, segment_ids and input masks first
-    for filing_feature in features:
-        for idx, paragraph_feature in enumerate(
-            filing_feature.list_input_features_paragraphs
-        ):
-            filing_feature.list_input_features_paragraphs[idx].input_ids = torch.tensor(
-                paragraph_feature.input_ids, dtype=torch.long
-            )
-            filing_feature.list_input_features_paragraphs[
-                idx
-            ].input_mask = torch.tensor(paragraph_feature.input_mask, dtype=torch.long)
-            filing_feature.list_input_features_paragraphs[
-                idx
-            ].segment_ids = torch.tensor(
-                paragraph_feature.segment_ids, dtype=torch.long
-            )
-        filing_feature.list_numerical_kpi_features = torch.tensor(
-            filing_feature.list_numerical_kpi_features, dtype=torch.float
+    return dataset
+
+
+def split_params(model, no_decay):
+    """Splits the parameters of a model into (decay, no_decay) in a single pass."""
+    # Substring match (not endswith) so that the LSTM "bias_ih_l0"/"bias_hh_l0" count as bias
+    decay, nodecay = [], []
+    for n, p in model.named_parameters():
+        (nodecay if any(nd in n for nd in no_decay) else decay).append(p)
+    return decay, nodecay
+
+
+def state_to_cpu(state):
+    """Recursively copies the tensors of a (model or optimizer) state dict to CPU."""
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", non_blocking=True, copy=True)
+    if isinstance(state, dict):
+        return {key: state_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(value) for value in state)
+    return state
+
+
+def save_checkpoint(
+    checkpoint, output_dir, global_step, global_step_file, old_checkpoint_dir=None
+):
+    for file_name, state in checkpoint.items():
+        torch.save(state, os.path.join(output_dir, file_name))
+    torch.save(global_step, global_step_file)
+
+    # Only drop the oldest checkpoint once the new one is completely written
+    if old_checkpoint_dir is not None:
+        try:
+            shutil.rmtree(old_checkpoint_dir)
+        except OSError as e:
+            print(e)
+
+
+def get_dataloader_kwargs(args, dataset):
+    # Load the batches in background workers into pinned memory for async copies to the GPU
+    # (the real paragraphs of a batch are gathered in the workers as well)
+    if isinstance(dataset, SECDataset):
+        collate_fn = collate_sec_paragraphs
+    elif isinstance(dataset, SECEncodedDataset):
+        collate_fn = collate_sec_encoded_paragraphs
+    else:
+        collate_fn = None
+    if args.num_workers == 0:
+        return {"pin_memory": args.device.type == "cuda", "collate_fn": collate_fn}
+    return {
+        "num_workers": args.num_workers,
+        "pin_memory": args.device.type == "cuda",
+        "collate_fn": collate_fn,
+        "persistent_workers": True,
+        "prefetch_factor": args.prefetch_factor,
+    }
+
+
+def encode_paragraphs(args, encoder_model, input_ids, input_mask, segment_ids):
+    """Encode a flat [num_paragraphs, max_seq_length] batch of paragraphs.
+
+    The paragraphs are passed through FinBERT and the adapter ensemble in chunks
+    of `args.paragraph_batch_size` and the [CLS] encodings are returned as a
+    single [num_paragraphs, hidden_size] tensor.
+    """
+    num_paragraphs = input_ids.size(0)
+    if args.torch_compile and num_paragraphs % args.paragraph_batch_size:
+        # Pad the last chunk with empty paragraphs, so that the compiled models (and
+        # their CUDA graphs) always see the same [paragraph_batch_size, seq] shape
+        num_padding = (
+            args.paragraph_batch_size - num_paragraphs % args.paragraph_batch_size
         )
+        input_ids = F.pad(input_ids, (0, 0, 0, num_padding))
+        input_mask = F.pad(input_mask, (0, 0, 0, num_padding))
+        segment_ids = F.pad(segment_ids, (0, 0, 0, num_padding))
+
+    encoded_paragraphs = None
+    for start in range(0, input_ids.size(0), args.paragraph_batch_size):
+        end = start + args.paragraph_batch_size
+        input_curr_paragraphs = {
+            "input_ids": input_ids[start:end],
+            "attention_mask": input_mask[start:end],
+            "token_type_ids": segment_ids[start:end],
+        }
+        # Without grouped params neither FinBERT nor the adapter ensemble is optimized,
+        # so autograd does not need to track them at all
+        with torch.inference_mode() if not args.grouped_params else nullcontext():
+            encoded_paragraph = encoder_model(**input_curr_paragraphs)
+        # Write every chunk into one [num_paragraphs, hidden_size] buffer. Allocated
+        # outside of inference mode it is a normal tensor that the RNN can save for its
+        # backward pass, and the copy also takes the encodings out of the CUDA graph
+        # outputs (mode="reduce-overhead"), which the next chunk's replay overwrites
+        if encoded_paragraphs is None:
+            encoded_paragraphs = encoded_paragraph.new_empty(
+                (input_ids.size(0), encoded_paragraph.size(-1))
+            )
+        encoded_paragraphs[start:end] = encoded_paragraph
 
-    # Process numerical KPI features
-    # kpi_features = torch.tensor([f.list_numerical_kpi_features for f in features], dtype=torch.float)
-    if output_mode == "classification":
-        all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.float)
-    elif output_mode == "regression":
-        all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.float)
+    return encoded_paragraphs[:num_paragraphs]
 
-    dataset = SECDataset(features, all_label_ids, args.max_seq_length)
 
-    return dataset
+def encode_batch(args, encoder_model, batch):
+    """Encode the paragraphs of a batch of filings from `collate_sec_paragraphs`.
+
+    Only the real paragraphs are passed through FinBERT and the adapter ensemble,
+    the encodings are scattered back into a zero-padded
+    [batch_size, max_num_paragraphs, hidden_size] tensor for the RNN.
+    """
+    # Padded paragraphs only appear after the real ones of each filing
+    curr_batch_num_paragraphs = batch[3]
+    max_num_paragraphs = int(curr_batch_num_paragraphs.max())
+    paragraph_positions = torch.arange(max_num_paragraphs)
+    paragraphs_mask = paragraph_positions[None, :] < curr_batch_num_paragraphs[:, None]
+
+    # The real paragraphs of the whole batch come as a single (pinned)
+    # [3, num_paragraphs, seq] tensor, so they are copied with one async transfer
+    curr_batch_inputs = batch[0].to(args.device, non_blocking=True)
+    (
+        curr_batch_input_ids,
+        curr_batch_input_masks,
+        curr_batch_segment_ids,
+    ) = curr_batch_inputs
+    curr_batch_paragraphs_mask = paragraphs_mask.to(args.device, non_blocking=True)
+
+    # Encode all real paragraphs of all filings in the batch at once
+    encoded_paragraphs = encode_paragraphs(
+        args,
+        encoder_model,
+        curr_batch_input_ids,
+        curr_batch_input_masks,
+        curr_batch_segment_ids,
+    )
+
+    # Scatter the encoded paragraphs back per filing into a single
+    # [batch, max_paragraphs, hidden] buffer
+    curr_batch_encoded_paragraphs = encoded_paragraphs.new_zeros(
+        curr_batch_num_paragraphs.size(0),
+        max_num_paragraphs,
+        encoded_paragraphs.size(-1),
+    )
+    curr_batch_encoded_paragraphs[curr_batch_paragraphs_mask] = encoded_paragraphs
+    return curr_batch_encoded_paragraphs
+
+
+def state_dict_sha1(model):
+    """SHA-1 over the names and values of all tensors in the state dict of a model."""
+    sha1 = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha1.update(name.encode("utf-8"))
+        sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+def precompute_paragraph_encodings(args, dataset, encoder_model, dataset_type):
+    """Encode all paragraphs of a `SECDataset` once with the frozen FinBERT.
+
+    The encodings are written into a .npy file in the output dir and memory-mapped
+    back as a `SECEncodedDataset`, so that only the RNN runs during training. A file
+    left by an earlier run (e.g. before resuming from a checkpoint) is reused only if
+    its .json sidecar matches the current dtype, encoder settings and adapter ensemble
+    weights, and `--overwrite_cache` is not given.
+    """
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    encodings_file = os.path.join(
+        args.output_dir, "paragraph_encodings_{}.npy".format(dataset_type)
+    )
+    metadata_file = os.path.splitext(encodings_file)[0] + ".json"
+    dtype = np.float16 if args.fp16 and args.device.type == "cuda" else np.float32
+    shape = (
+        len(dataset),
+        dataset.input_ids.size(1),
+        encoder_model.pretrained_model.config.hidden_size,
+    )
+    metadata = {
+        "dtype": np.dtype(dtype).name,
+        "shape": list(shape),
+        "finbert_path": args.finbert_path,
+        "quantize_finbert": args.quantize_finbert,
+        "meta_sec_adaptermodel": args.meta_sec_adaptermodel,
+        "adapter_list": args.adapter_list,
+        "adapter_skip_layers": args.adapter_skip_layers,
+        "fusion_mode": args.fusion_mode,
+        "seed": args.seed,
+        "adapter_ensemble_sha1": state_dict_sha1(encoder_model.adapter_ensemble_model),
+    }
+    if (
+        os.path.exists(encodings_file)
+        and os.path.exists(metadata_file)
+        and not args.overwrite_cache
+    ):
+        with open(metadata_file, "r") as reader:
+            cached_metadata = json.load(reader)
+        if cached_metadata == metadata:
+            logger.info("Loading paragraph encodings from %s", encodings_file)
+            return SECEncodedDataset(
+                torch.from_numpy(np.load(encodings_file, mmap_mode="c")),
+                dataset.num_paragraphs,
+                dataset.kpi_features,
+                dataset.labels_ids,
+            )
+        logger.info("Paragraph encodings in %s are outdated", encodings_file)
+
+    # The sidecar is only written back once the encodings are complete
+    if os.path.exists(metadata_file):
+        os.remove(metadata_file)
+
+    encoder_model.eval()
+    dataloader = DataLoader(
+        dataset,
+        sampler=SequentialSampler(dataset),
+        batch_size=args.eval_batch_size,
+        **get_dataloader_kwargs(args, dataset),
+    )
+
+    logger.info("Encoding the %s paragraphs into %s", dataset_type, encodings_file)
+    encodings = np.lib.format.open_memmap(
+        encodings_file, mode="w+", dtype=dtype, shape=shape
+    )
+    start = 0
+    for batch in tqdm(dataloader, desc="Encoding"):
+        with torch.cuda.amp.autocast(enabled=args.fp16):
+            curr_batch_encoded_paragraphs = encode_batch(args, encoder_model, batch)
+        end = start + curr_batch_encoded_paragraphs.size(0)
+        encodings[
+            start:end, : curr_batch_encoded_paragraphs.size(1)
+        ] = curr_batch_encoded_paragraphs.cpu().numpy()
+        start = end
+    encodings.flush()
+    del encodings
+    with open(metadata_file, "w") as writer:
+        json.dump(metadata, writer)
+
+    return SECEncodedDataset(
+        torch.from_numpy(np.load(encodings_file, mmap_mode="c")),
+        dataset.num_paragraphs,
+        dataset.kpi_features,
+        dataset.labels_ids,
+    )
+
+
+def get_train_val_dataloaders(args, train_dataset, val_dataset):
+    # Shuffle with a dedicated generator, the global RNGs are seeded once in main
+    train_generator = torch.Generator()
+    train_generator.manual_seed(args.seed)
+    train_sampler = (
+        RandomSampler(train_dataset, generator=train_generator)
+        if args.local_rank == -1
+        else DistributedSampler(train_dataset)
+    )
+    train_dataloader = DataLoader(
+        train_dataset,
+        sampler=train_sampler,
+        batch_size=args.train_batch_size // args.gradient_accumulation_steps,
+        **get_dataloader_kwargs(args, train_dataset),
+    )
+    # Created once so that its workers are kept alive between the evaluations
+    val_dataloader = DataLoader(
+        val_dataset,
+        sampler=SequentialSampler(val_dataset),
+        batch_size=args.eval_batch_size,
+        **get_dataloader_kwargs(args, val_dataset),
+    )
+    return train_dataloader, val_dataloader
 
 
 def train(args, train_dataset, val_dataset, model, tokenizer):
@@ -572,19 +923,13 @@ def train(args, train_dataset, val_dataset, model, tokenizer):
     adapter_ensemble_model = model[1]
     rnn_model = model[2]
     kpi_model = model[3]
+    encoder_model = model[4]
 
     if args.local_rank in [-1, 0]:
         tb_writer = SummaryWriter(log_dir="runs/" + args.my_model_name)
 
-    train_sampler = (
-        RandomSampler(train_dataset)
-        if args.local_rank == -1
-        else DistributedSampler(train_dataset)
-    )
-    train_dataloader = DataLoader(
-        train_dataset,
-        sampler=train_sampler,
-        batch_size=args.train_batch_size // args.gradient_accumulation_steps,
+    train_dataloader, val_dataloader = get_train_val_dataloaders(
+        args, train_dataset, val_dataset
     )
 
     if args.max_steps > 0:
@@ -610,41 +955,31 @@ def train(args, train_dataset, val_dataset, model, tokenizer):
     # This lets us combine parameters which we want to change using the optimizer. Can be from couple of models
     # Use these grouped parameters only if we want to touch the BERT weights as well
     if args.grouped_params:
+        finbert_decay, _ = split_params(pretrained_finbert_model, no_decay)
+        _, adapter_ensemble_no_decay = split_params(adapter_ensemble_model, no_decay)
+        _, rnn_no_decay = split_params(rnn_model, no_decay)
         optimizer_grouped_parameters = [
-            {
-                "params": [
-                    p
-                    for n, p in pretrained_finbert_model.named_parameters()
-                    if not any(nd in n for nd in no_decay)
-                ],
-                "weight_decay": 0.0,
-            },
+            {"params": finbert_decay, "weight_decay": 0.0},
             # Adapter Ensemble Bert model parameters
-            {
-                "params": [
-                    p
-                    for n, p in adapter_ensemble_model.named_parameters()
-                    if any(nd in n for nd in no_decay)
-                ],
-                "weight_decay": 0.0,
-            },
+            {"params": adapter_ensemble_no_decay, "weight_decay": 0.0},
             # RNN Model parameters
-            {
-                "params": [
-                    p
-                    for n, p in rnn_model.named_parameters()
-                    if any(nd in n for nd in no_decay)
-                ],
-                "weight_decay": 0.0,
-            },
+            {"params": rnn_no_decay, "weight_decay": 0.0},
         ]
     else:
         optimizer_grouped_parameters = rnn_model.parameters()
 
+    # A single fused CUDA kernel updates all parameters from PyTorch 2.0 on
+    optimizer_kwargs = {}
+    if args.device.type == "cuda" and "fused" in inspect.signature(AdamW).parameters:
+        optimizer_kwargs["fused"] = True
     optimizer = AdamW(
-        optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon
+        optimizer_grouped_parameters,
+        lr=args.learning_rate,
+        eps=args.adam_epsilon,
+        weight_decay=0.0,
+        **optimizer_kwargs,
     )
-    scheduler = WarmupLinearSchedule(
+    scheduler = get_linear_schedule_with_warmup(
         optimizer, warmup_steps=args.warmup_steps, t_total=t_total
     )
 
@@ -717,7 +1052,23 @@ def train(args, train_dataset, val_dataset, model, tokenizer):
             pass
         logger.info("Start from scratch")
 
-    rnn_tr_loss, overall_tr_loss = 0.0, 0.0
+    # Without grouped params FinBERT and the adapter ensemble are never updated, so
+    # their paragraph encodings are the same in every epoch. Encoded only here, after
+    # the adapter ensemble of a restored checkpoint is loaded
+    if not args.grouped_params:
+        train_dataset = precompute_paragraph_encodings(
+            args, train_dataset, encoder_model, "train"
+        )
+        val_dataset = precompute_paragraph_encodings(
+            args, val_dataset, encoder_model, "val"
+        )
+        train_dataloader, val_dataloader = get_train_val_dataloaders(
+            args, train_dataset, val_dataset
+        )
+
+    # Running losses stay on the device, they are only synced when logged
+    rnn_tr_loss = torch.zeros((), device=args.device)
+    overall_tr_loss = torch.zeros((), device=args.device)
     pretrained_finbert_model.zero_grad()
     adapter_ensemble_model.zero_grad()
     rnn_model.zero_grad()
@@ -728,134 +1079,97 @@ def train(args, train_dataset, val_dataset, model, tokenizer):
         desc="Epoch",
         disable=args.local_rank not in [-1, 0],
     )
-    set_seed(args)  # Added here for reproductibility (even between python 2 and 3)
     loss_fct = MSELoss()
+    scaler = torch.cuda.amp.GradScaler(enabled=args.fp16)
+    # Checkpoints are written by a background thread, one at a time
+    checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+    checkpoint_future = None
     for epoch_step in train_iterator:
         epoch_iterator = tqdm(
             train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0]
         )
-        rnn_epoch_loss = 0
-        overall_epoch_loss = 0
+        rnn_epoch_loss = torch.zeros((), device=args.device)
+        overall_epoch_loss = torch.zeros((), device=args.device)
         for step, batch in enumerate(epoch_iterator):
             if args.grouped_params:
                 pretrained_finbert_model.train()
                 adapter_ensemble_model.train()
             rnn_model.train()
 
-            curr_batch_input_ids = defaultdict(list)
-            curr_batch_input_masks = defaultdict(list)
-            curr_batch_segment_ids = defaultdict(list)
-
-            # Organize the input data for the whole batch in a better way
-            for item_paragraph in batch[0]:
-                for idx in range(item_paragraph["input_ids"].shape[0]):
-                    curr_batch_input_ids[idx].append(item_paragraph["input_ids"][idx])
-                    curr_batch_input_masks[idx].append(
-                        item_paragraph["input_mask"][idx]
-                    )
-                    curr_batch_segment_ids[idx].append(
-                        item_paragraph["segment_ids"][idx]
-                    )
+            curr_batch_num_paragraphs = batch[3]
+            curr_batch_labels = batch[2].to(args.device, non_blocking=True).unsqueeze(1)
 
-            curr_batch_outputs_from_rnn = []
-            # Process curr batch of filings from the batch
-            for my_batch in range(len(curr_batch_input_ids)):
-                curr_filing_input_ids = curr_batch_input_ids[my_batch]
-                curr_filing_input_masks = curr_batch_input_masks[my_batch]
-                curr_filing_segment_ids = curr_batch_segment_ids[my_batch]
-
-                curr_filing_encoded_paragraphs = []
-                for input_ids, input_masks, segment_ids in zip(
-                    curr_filing_input_ids,
-                    curr_filing_input_masks,
-                    curr_filing_segment_ids,
-                ):
-                    # Check if all paragraphs are processed
-                    if (
-                        np.count_nonzero(input_ids) == 0
-                        and np.count_nonzero(input_masks) == 0
-                        and np.count_nonzero(segment_ids) == 0
-                    ):
-                        break
-
-                    # batch = tuple(t.to(args.device) for t in batch)
-                    input_curr_paragraph = {
-                        "input_ids": input_ids[None, :].to(args.device),
-                        "attention_mask": input_masks[None, :].to(args.device),
-                        "token_type_ids": segment_ids[None, :].to(args.device),
-                    }
-
-                    pretrained_model_outputs = pretrained_finbert_model(
-                        **input_curr_paragraph
+            with torch.cuda.amp.autocast(enabled=args.fp16):
+                if args.grouped_params:
+                    curr_batch_encoded_paragraphs = encode_batch(
+                        args, encoder_model, batch
                     )
-                    encoded_paragraph = adapter_ensemble_model(
-                        pretrained_model_outputs, **input_curr_paragraph
+                else:
+                    # The frozen encodings were computed once before training, and come
+                    # already trimmed to the longest filing of the batch
+                    curr_batch_encoded_paragraphs = batch[0].to(
+                        args.device, non_blocking=True
                     )
-                    curr_filing_encoded_paragraphs.append(encoded_paragraph.squeeze(0))
+                    if not args.fp16:
+                        curr_batch_encoded_paragraphs = (
+                            curr_batch_encoded_paragraphs.float()
+                        )
 
                 """
-                    Use the RNN and generate the loss for this filing
+                    Use the RNN and generate the loss for the filings
                 """
-
-                # Convert list to tensor
-                curr_filing_encoded_paragraphs = torch.stack(
-                    curr_filing_encoded_paragraphs
+                curr_batch_outputs_from_rnn = rnn_model(
+                    curr_batch_encoded_paragraphs, curr_batch_num_paragraphs
                 )
-                curr_filing_encoded_paragraphs = (
-                    curr_filing_encoded_paragraphs.unsqueeze(0).to(args.device)
-                )
-
-                rnn_output_for_filing = rnn_model(curr_filing_encoded_paragraphs)
-                curr_batch_outputs_from_rnn.append(rnn_output_for_filing)
 
-            # Convert list to tensor for RNN outputs
-            curr_batch_outputs_from_rnn = torch.stack(curr_batch_outputs_from_rnn)
-            curr_batch_outputs_from_rnn = curr_batch_outputs_from_rnn.squeeze(1)
-            curr_batch_labels = batch[2].to(args.device).unsqueeze(1)
-
-            # Run the through the KPI model
-
-            # with torch.no_grad():
-            #     kpi_outputs = kpi_model(batch[1].to(args.device), curr_batch_labels)
-            #     kpi_loss = kpi_outputs[0]
-
-            rnn_loss = loss_fct(curr_batch_outputs_from_rnn, curr_batch_labels)
+                rnn_loss = loss_fct(curr_batch_outputs_from_rnn, curr_batch_labels)
+                if args.is_kpi_loss:
+                    # The XGBoost model runs on CPU, so give it the labels still on the host
+                    kpi_mse_loss = kpi_model.get_mse_loss(
+                        batch[1], batch[2].unsqueeze(1)
+                    )
+                    # Change to gradually decrease
+                    curr_alpha = get_curr_alpha(global_step, t_total)
+                    overall_loss = custom_loss(rnn_loss, kpi_mse_loss, curr_alpha)
+
+            # Average the gradients over the accumulated mini-batches
+            loss = overall_loss if args.is_kpi_loss else rnn_loss
+            if args.gradient_accumulation_steps > 1:
+                loss = loss / args.gradient_accumulation_steps
+            scaler.scale(loss).backward()
+
+            rnn_tr_loss += rnn_loss.detach()
+            rnn_epoch_loss += rnn_loss.detach()
             if args.is_kpi_loss:
-                kpi_mse_loss = kpi_model.get_mse_loss(batch[1], curr_batch_labels)
-                # Change to gradually decrease
-                curr_alpha = get_curr_alpha(global_step, t_total)
-                overall_loss = custom_loss(rnn_loss, kpi_mse_loss, curr_alpha)
-                overall_loss.backward()
-                epoch_iterator.set_description(
-                    "overall tr loss {}".format(overall_loss)
-                )
-                epoch_iterator.set_description("alpha {}".format(curr_alpha))
-            else:
-                rnn_loss.backward()
+                overall_tr_loss += overall_loss.detach()
+                overall_epoch_loss += overall_loss.detach()
 
-            epoch_iterator.set_description("rnn tr loss {}".format(rnn_loss))
-
-            """Clipping gradients"""
-            if args.max_grad_norm > 0:
-                if args.grouped_params:
-                    torch.nn.utils.clip_grad_norm_(
-                        pretrained_finbert_model.parameters(), args.max_grad_norm
+            if args.logging_steps > 0 and step % args.logging_steps == 0:
+                if args.is_kpi_loss:
+                    epoch_iterator.set_description(
+                        "overall tr loss {}".format(overall_loss.item())
                     )
+                    epoch_iterator.set_description("alpha {}".format(curr_alpha))
+                epoch_iterator.set_description("rnn tr loss {}".format(rnn_loss.item()))
+
+            if (step + 1) % args.gradient_accumulation_steps == 0:
+                """Clipping gradients"""
+                if args.max_grad_norm > 0:
+                    # Clip the real gradients and not the loss-scaled ones
+                    scaler.unscale_(optimizer)
+                    if args.grouped_params:
+                        torch.nn.utils.clip_grad_norm_(
+                            pretrained_finbert_model.parameters(), args.max_grad_norm
+                        )
+                        torch.nn.utils.clip_grad_norm_(
+                            adapter_ensemble_model.parameters(), args.max_grad_norm
+                        )
                     torch.nn.utils.clip_grad_norm_(
-                        adapter_ensemble_model.parameters(), args.max_grad_norm
+                        rnn_model.parameters(), args.max_grad_norm
                     )
-                torch.nn.utils.clip_grad_norm_(
-                    rnn_model.parameters(), args.max_grad_norm
-                )
-
-            rnn_tr_loss += rnn_loss.item()
-            rnn_epoch_loss += rnn_loss.item()
-            if args.is_kpi_loss:
-                overall_tr_loss += overall_loss.item()
-                overall_epoch_loss += overall_loss.item()
 
-            if (step + 1) % args.gradient_accumulation_steps == 0:
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()  # Update learning rate schedule
 
                 pretrained_finbert_model.zero_grad()
@@ -865,17 +1179,23 @@ def train(args, train_dataset, val_dataset, model, tokenizer):
 
         # Epoch ended
         # Log metrics training
-        tb_writer.add_scalar("lr", scheduler.get_lr()[0], epoch_step)
-        tb_writer.add_scalar("rnn_tr_loss", rnn_epoch_loss / (step + 1), epoch_step)
+        tb_writer.add_scalar("lr", scheduler.get_last_lr()[0], epoch_step)
+        tb_writer.add_scalar(
+            "rnn_tr_loss", (rnn_epoch_loss / (step + 1)).item(), epoch_step
+        )
         if args.is_kpi_loss:
             tb_writer.add_scalar("alpha", curr_alpha, epoch_step)
             tb_writer.add_scalar(
-                "overall_tr_loss", overall_epoch_loss / (step + 1), epoch_step
+                "overall_tr_loss", (overall_epoch_loss / (step + 1)).item(), epoch_step
             )
             # Log metrics evaluation
-            results = evaluate(args, val_dataset, model, curr_alpha)
+            results = evaluate(
+                args, val_dataset, model, curr_alpha, eval_dataloader=val_dataloader
+            )
         else:
-            results = evaluate(args, val_dataset, model, 0)
+            results = evaluate(
+                args, val_dataset, model, 0, eval_dataloader=val_dataloader
+            )
 
         for key, value in results.items():
             tb_writer.add_scalar("eval_{}".format(key), value, epoch_step)
@@ -890,41 +1210,43 @@ def train(args, train_dataset, val_dataset, model, tokenizer):
             )
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
-            rnn_model.save_pretrained(
-                output_dir
-            )  # save to pytorch_model.bin  model.state_dict()
-            adapter_ensemble_model.save_pretrained(
-                output_dir
-            )  # save to pytorch_model.bin  model.state_dict()
-
-            torch.save(
-                optimizer.state_dict(),
-                os.path.join(output_dir, "optimizer.bin"),
-            )
-            torch.save(
-                scheduler.state_dict(),
-                os.path.join(output_dir, "scheduler.bin"),
+            # Copy the state to CPU here and let the background thread do the disk I/O
+            checkpoint = {
+                "rnn_pytorch_model.bin": state_to_cpu(rnn_model.state_dict()),
+                "adapter_ensemble_pytorch_model.bin": state_to_cpu(
+                    adapter_ensemble_model.state_dict()
+                ),
+                "optimizer.bin": state_to_cpu(optimizer.state_dict()),
+                "scheduler.bin": scheduler.state_dict(),
+                "training_args.bin": args,
+            }
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            adapter_ensemble_model.config.save_pretrained(output_dir)
+            old_checkpoint_dir = None
+            if (epoch_step / args.save_epoch_steps) > args.max_save_checkpoints:
+                old_checkpoint_dir = os.path.join(
+                    args.output_dir,
+                    "checkpoint-{}".format(
+                        epoch_step - args.max_save_checkpoints * args.save_epoch_steps
+                    ),
+                )
+            # Re-raise an error of the previous save before queueing the next one
+            if checkpoint_future is not None:
+                checkpoint_future.result()
+            checkpoint_future = checkpoint_executor.submit(
+                save_checkpoint,
+                checkpoint,
+                output_dir,
+                global_step,
+                os.path.join(args.output_dir, "global_step.bin"),
+                old_checkpoint_dir,
             )
-            torch.save(args, os.path.join(output_dir, "training_args.bin"))
-            torch.save(global_step, os.path.join(args.output_dir, "global_step.bin"))
 
             logger.info(
                 "Saving model checkpoint, optimizer, global_step to %s",
                 output_dir,
             )
-            if (epoch_step / args.save_epoch_steps) > args.max_save_checkpoints:
-                try:
-                    shutil.rmtree(
-                        os.path.join(
-                            args.output_dir,
-                            "checkpoint-{}".format(
-                                epoch_step
-                                - args.max_save_checkpoints * args.save_epoch_steps
-                            ),
-                        )
-                    )
-                except OSError as e:
-                    print(e)
 
         if (
             args.max_steps > 0 and global_step > args.max_steps
@@ -932,6 +1254,11 @@ def train(args, train_dataset, val_dataset, model, tokenizer):
             epoch_iterator.close()
             break
 
+    # Wait for the pending checkpoint and re-raise any error of the saving thread
+    checkpoint_executor.shutdown(wait=True)
+    if checkpoint_future is not None:
+        checkpoint_future.result()
+
     if args.local_rank in [-1, 0]:
         tb_writer.close()
 
@@ -941,12 +1268,13 @@ def train(args, train_dataset, val_dataset, model, tokenizer):
 save_results = []
 
 
-def evaluate(args, eval_dataset, model, curr_alpha, prefix=""):
+def evaluate(args, eval_dataset, model, curr_alpha, prefix="", eval_dataloader=None):
     loss_fct = MSELoss()
     pretrained_finbert_model = model[0]
     adapter_ensemble_model = model[1]
     rnn_model = model[2]
     kpi_model = model[3]
+    encoder_model = model[4]
 
     results = {}
 
@@ -955,105 +1283,63 @@ def evaluate(args, eval_dataset, model, curr_alpha, prefix=""):
 
     # args.eval_batch_size = args.eval_batch_size * max(1, args.n_gpu)
     # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(
-        eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size
-    )
+    if eval_dataloader is None:
+        eval_sampler = SequentialSampler(eval_dataset)
+        eval_dataloader = DataLoader(
+            eval_dataset,
+            sampler=eval_sampler,
+            batch_size=args.eval_batch_size,
+            **get_dataloader_kwargs(args, eval_dataset),
+        )
 
     # Eval!
     logger.info("***** Running evaluation {} *****".format(prefix))
     logger.info("  Num examples = %d", len(eval_dataset))
     logger.info("  Validation Batch size = %d", args.eval_batch_size)
-    eval_rnn_loss, eval_overall_loss = 0.0, 0.0
-    nb_eval_steps = 0
+    # The per-batch losses stay on the device and are reduced once after the loop
+    eval_rnn_losses, eval_overall_losses = [], []
+    use_autocast = args.device.type == "cuda"
 
+    pretrained_finbert_model.eval()
+    adapter_ensemble_model.eval()
+    rnn_model.eval()
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
-        pretrained_finbert_model.eval()
-        adapter_ensemble_model.eval()
-        rnn_model.eval()
-
-        curr_batch_input_ids = defaultdict(list)
-        curr_batch_input_masks = defaultdict(list)
-        curr_batch_segment_ids = defaultdict(list)
-
-        # Organize the input data for the whole batch in a better way
-        for item_paragraph in batch[0]:
-            for idx in range(item_paragraph["input_ids"].shape[0]):
-                curr_batch_input_ids[idx].append(item_paragraph["input_ids"][idx])
-                curr_batch_input_masks[idx].append(item_paragraph["input_mask"][idx])
-                curr_batch_segment_ids[idx].append(item_paragraph["segment_ids"][idx])
-
-        curr_batch_outputs_from_rnn = []
-        # Process curr batch of filings from the batch
-        for my_batch in range(len(curr_batch_input_ids)):
-            curr_filing_input_ids = curr_batch_input_ids[my_batch]
-            curr_filing_input_masks = curr_batch_input_masks[my_batch]
-            curr_filing_segment_ids = curr_batch_segment_ids[my_batch]
-
-            curr_filing_encoded_paragraphs = []
-            for input_ids, input_masks, segment_ids in zip(
-                curr_filing_input_ids,
-                curr_filing_input_masks,
-                curr_filing_segment_ids,
-            ):
-                # Check if all paragraphs are processed
-                if (
-                    np.count_nonzero(input_ids) == 0
-                    and np.count_nonzero(input_masks) == 0
-                    and np.count_nonzero(segment_ids) == 0
-                ):
-                    break
-
-                # batch = tuple(t.to(args.device) for t in batch)
-                input_curr_paragraph = {
-                    "input_ids": input_ids[None, :].to(args.device),
-                    "attention_mask": input_masks[None, :].to(args.device),
-                    "token_type_ids": segment_ids[None, :].to(args.device),
-                }
-
-                with torch.no_grad():
-                    pretrained_model_outputs = pretrained_finbert_model(
-                        **input_curr_paragraph
-                    )
-                    encoded_paragraph = adapter_ensemble_model(
-                        pretrained_model_outputs, **input_curr_paragraph
+        # Nothing is trained here, so skip autograd entirely and run in half precision
+        # on the GPU
+        with torch.inference_mode(), torch.cuda.amp.autocast(enabled=use_autocast):
+            if isinstance(eval_dataset, SECEncodedDataset):
+                # The paragraphs were already encoded by the frozen FinBERT
+                curr_batch_encoded_paragraphs = batch[0].to(
+                    args.device, non_blocking=True
+                )
+                if not use_autocast:
+                    curr_batch_encoded_paragraphs = (
+                        curr_batch_encoded_paragraphs.float()
                     )
-                curr_filing_encoded_paragraphs.append(encoded_paragraph.squeeze(0))
-
-            """
-                Use the RNN and generate the loss for this filing
-            """
-
-            # Convert list to tensor
-            curr_filing_encoded_paragraphs = torch.stack(curr_filing_encoded_paragraphs)
-            curr_filing_encoded_paragraphs = curr_filing_encoded_paragraphs.unsqueeze(
-                0
-            ).to(args.device)
-
-            with torch.no_grad():
-                rnn_output_for_filing = rnn_model(curr_filing_encoded_paragraphs)
-            curr_batch_outputs_from_rnn.append(rnn_output_for_filing)
-
-        # Convert list to tensor for RNN outputs
-        curr_batch_outputs_from_rnn = torch.stack(curr_batch_outputs_from_rnn)
-        curr_batch_outputs_from_rnn = curr_batch_outputs_from_rnn.squeeze(1)
-        curr_batch_labels = batch[2].to(args.device).unsqueeze(1)
+            else:
+                # All real paragraphs of the batch go through FinBERT in one forward pass
+                curr_batch_encoded_paragraphs = encode_batch(args, encoder_model, batch)
+            curr_batch_outputs_from_rnn = rnn_model(
+                curr_batch_encoded_paragraphs, batch[3]
+            )
+        # Compute the loss in fp32
+        curr_batch_outputs_from_rnn = curr_batch_outputs_from_rnn.float()
+        curr_batch_labels = batch[2].to(args.device, non_blocking=True).unsqueeze(1)
         tmp_eval_rnn_loss = loss_fct(curr_batch_outputs_from_rnn, curr_batch_labels)
 
         if args.is_kpi_loss:
-            tmp_kpi_mse_loss = kpi_model.get_mse_loss(batch[1], curr_batch_labels)
+            tmp_kpi_mse_loss = kpi_model.get_mse_loss(batch[1], batch[2].unsqueeze(1))
             tmp_overall_loss = custom_loss(
                 tmp_eval_rnn_loss, tmp_kpi_mse_loss, curr_alpha
             )
-            eval_overall_loss += tmp_overall_loss
+            eval_overall_losses.append(tmp_overall_loss.detach())
 
-        eval_rnn_loss += tmp_eval_rnn_loss.item()
-        nb_eval_steps += 1
+        eval_rnn_losses.append(tmp_eval_rnn_loss.detach())
 
-    eval_rnn_loss = eval_rnn_loss / nb_eval_steps
+    eval_rnn_loss = torch.stack(eval_rnn_losses).mean().item()
 
     if args.is_kpi_loss:
-        eval_overall_loss = eval_overall_loss / nb_eval_steps
+        eval_overall_loss = torch.stack(eval_overall_losses).mean().item()
         results["overall_loss"] = eval_overall_loss
 
     results["rnn_loss"] = eval_rnn_loss
@@ -1252,6 +1538,17 @@ def main():
         help="Are we using grouped params for finbert, ensemble and rnn",
     )
 
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="Recompute the FinBERT activations in the backward pass to save memory (with grouped params)",
+    )
+    parser.add_argument(
+        "--quantize_finbert",
+        action="store_true",
+        help="Run the frozen FinBERT with dynamically int8 quantized linear layers (CPU only, without grouped params and fp16)",
+    )
+
     parser.add_argument(
         "--final_epoch",
         type=int,
@@ -1356,6 +1653,24 @@ def main():
         type=int,
         help="Batch size for evaluation.",
     )
+    parser.add_argument(
+        "--num_workers",
+        default=min(8, len(os.sched_getaffinity(0))),
+        type=int,
+        help="Number of DataLoader worker processes, 0 loads the batches in the main process.",
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        default=2,
+        type=int,
+        help="Number of batches loaded in advance by each DataLoader worker.",
+    )
+    parser.add_argument(
+        "--paragraph_batch_size",
+        default=32,
+        type=int,
+        help="Number of paragraphs passed through FinBERT in a single forward pass.",
+    )
     parser.add_argument(
         "--gradient_accumulation_steps",
         type=int,
@@ -1429,18 +1744,21 @@ def main():
         help="Whether restore from the last checkpoint, is nochenckpoints, start from scartch",
     )
 
-    # parser.add_argument(
-    #     "--fp16",
-    #     action="store_true",
-    #     help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
-    # )
-    # parser.add_argument(
-    #     "--fp16_opt_level",
-    #     type=str,
-    #     default="O1",
-    #     help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-    #     "See details at https://nvidia.github.io/apex/amp.html",
-    # )
+    parser.add_argument(
+        "--fp16",
+        action="store_true",
+        help="Whether to use 16-bit (mixed) precision (through torch.cuda.amp) instead of 32-bit",
+    )
+    parser.add_argument(
+        "--tf32",
+        action="store_true",
+        help="Allow TF32 matmuls and cuDNN convolutions on Ampere (or newer) GPUs",
+    )
+    parser.add_argument(
+        "--torch_compile",
+        action="store_true",
+        help="Compile FinBERT and the adapter ensemble with torch.compile (PyTorch >= 2.0)",
+    )
     parser.add_argument(
         "--max_save_checkpoints",
         type=int,
@@ -1463,12 +1781,22 @@ def main():
 
     args = parser.parse_args()
 
+    # Must be set before the first CUDA allocation. Limiting the block splitting (and
+    # growing segments in place on newer PyTorch) keeps the variable sized paragraph
+    # batches from fragmenting the caching allocator
+    if tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 1):
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+    else:
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "max_split_size_mb:128")
+
+    finbert_basename = os.path.basename(os.path.normpath(args.finbert_path))
+
     args.adapter_list = args.adapter_list.split(",")
     args.adapter_list = [int(i) for i in args.adapter_list]
 
     for data_dir in args.data_dirs.split(","):
         args.data_dir = data_dir
-        name_prefix = f"{list(filter(None, args.finbert_path.split('/'))).pop()}_{args.percentage_change_type}_kfold-{args.data_dir.split('_')[-1]}_max_seq-{args.max_seq_length}_batch-{args.train_batch_size}_lr-{args.learning_rate}_warmup-{args.warmup_steps}_epoch-{args.num_train_epochs}_adapter-{args.is_adapter}_kpiLoss-{args.is_kpi_loss}_adversarial-{args.is_adversarial}_max_grad_norm-{args.max_grad_norm}_grouped_params-{args.grouped_params}_{args.type_text}_comment-{args.comment}"
+        name_prefix = f"{finbert_basename}_{args.percentage_change_type}_kfold-{args.data_dir.split('_')[-1]}_max_seq-{args.max_seq_length}_batch-{args.train_batch_size}_lr-{args.learning_rate}_warmup-{args.warmup_steps}_epoch-{args.num_train_epochs}_adapter-{args.is_adapter}_kpiLoss-{args.is_kpi_loss}_adversarial-{args.is_adversarial}_max_grad_norm-{args.max_grad_norm}_grouped_params-{args.grouped_params}_{args.type_text}_comment-{args.comment}"
         args.my_model_name = args.task_name + "_" + name_prefix
         if args.output_dir != "./output":
             args.output_dir = "./output"
@@ -1495,12 +1823,9 @@ def main():
         set_seed(args)
 
         # Choose tokenizer for BERT or FinBERT
-        if (
-            list(filter(None, args.finbert_path.split("/"))).pop()
-            == "bert-base-uncased"
-        ):
+        if finbert_basename == "bert-base-uncased":
             tokenizer = BertTokenizerLocal.from_pretrained("bert-base-uncased")
-        elif list(filter(None, args.finbert_path.split("/"))).pop() == "FinBERT":
+        elif finbert_basename == "FinBERT":
             tokenizer = BertTokenizerHugging.from_pretrained(
                 "yiyanghkust/finbert-tone", model_max_length=args.max_seq_length
             )
@@ -1520,23 +1845,51 @@ def main():
         rnn_model = RNNModel(args)
         # Load KPI model and freeze params
         kpi_model = KPIModelXGBoost(args.kpi_model_path)
-        # kpi_model.load_state_dict(
-        #     torch.load(args.kpi_model_path, map_location=torch.device(args.device))
-        # )
-        # for p in kpi_model.parameters():
-        #     p.requires_grad = False
-        # kpi_model.eval()
 
         pretrained_model.to(args.device)
         adapter_ensemble_model.to(args.device)
         rnn_model.to(args.device)
-        # kpi_model.to(args.device)
+
+        if args.quantize_finbert:
+            # Dynamic quantization only has fp32 CPU kernels and cannot be trained through
+            if args.device.type == "cpu" and not args.grouped_params and not args.fp16:
+                pretrained_model.model = torch.quantization.quantize_dynamic(
+                    pretrained_model.model, {nn.Linear}, dtype=torch.qint8
+                )
+            else:
+                logger.warning(
+                    "FinBERT is only quantized on CPU, without grouped params and fp16"
+                )
+
+        if args.tf32:
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+
+        # FinBERT and the adapter ensemble always run back to back
+        encoder_model = PretrainedAdapterEnsembleModel(
+            pretrained_model, adapter_ensemble_model
+        )
+
+        # The KPI model is not compiled, it is not a torch module
+        if args.torch_compile:
+            if hasattr(torch, "compile"):
+                import torch._dynamo
+
+                torch._dynamo.config.cache_size_limit = 128
+                # The RNN is left eager, its [batch, paragraphs, hidden] input changes
+                # shape on nearly every batch and would be recompiled each time
+                compile_model(encoder_model)
+            else:
+                logger.warning(
+                    "torch.compile needs PyTorch >= 2.0, running the models eagerly"
+                )
 
         full_ensemble_model = (
             pretrained_model,
             adapter_ensemble_model,
             rnn_model,
             kpi_model,
+            encoder_model,
         )
 
         logger.info("Training/evaluation parameters %s", args)
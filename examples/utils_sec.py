@@ -478,6 +478,44 @@ def convert_examples_to_features_sec(
     return features
 
 
+def convert_features_to_arrays_sec(features, max_seq_length):
+    """Converts a list of `InputFeaturesFiling`s into dense numpy arrays.
+
+    The paragraphs of all filings are zero-padded up to the filing with the most
+    paragraphs, so `input_ids`, `input_mask` and `segment_ids` have the shape
+    [num_filings, max_paragraphs, max_seq_length]. `num_paragraphs` holds the
+    number of real paragraphs of every filing.
+    """
+    max_paragraphs = max(len(f.list_input_features_paragraphs) for f in features)
+    input_ids = np.zeros(
+        (len(features), max_paragraphs, max_seq_length), dtype=np.int64
+    )
+    input_mask = np.zeros_like(input_ids)
+    segment_ids = np.zeros_like(input_ids)
+    num_paragraphs = np.zeros(len(features), dtype=np.int64)
+    kpi_features = np.zeros(
+        (len(features), len(features[0].list_numerical_kpi_features)), dtype=np.float32
+    )
+    label_ids = np.zeros(len(features), dtype=np.float32)
+    for idx_f, filing_feature in enumerate(features):
+        paragraphs = filing_feature.list_input_features_paragraphs
+        input_ids[idx_f, : len(paragraphs)] = [p.input_ids for p in paragraphs]
+        input_mask[idx_f, : len(paragraphs)] = [p.input_mask for p in paragraphs]
+        segment_ids[idx_f, : len(paragraphs)] = [p.segment_ids for p in paragraphs]
+        num_paragraphs[idx_f] = len(paragraphs)
+        kpi_features[idx_f] = filing_feature.list_numerical_kpi_features
+        label_ids[idx_f] = filing_feature.label_id
+
+    return {
+        "input_ids": input_ids,
+        "input_mask": input_mask,
+        "segment_ids": segment_ids,
+        "num_paragraphs": num_paragraphs,
+        "kpi_features": kpi_features,
+        "label_ids": label_ids,
+    }
+
+
 def convert_examples_to_features_sec_adapter(
     examples,
     label_list,
@@ -576,53 +614,100 @@ def compute_metrics(task_name, preds, labels):
 
 
 class SECDataset(Dataset):
-    def __init__(self, filings_features, labels_ids, max_seq_length):
-
-        self.filings_features = []
-        longest_list_paragraphs = 0
-        for idx_f, curr_filing_features in enumerate(filings_features):
-            curr_list_of_paragraphs = []
-            for idx_p, paragraph_features in enumerate(
-                curr_filing_features.list_input_features_paragraphs
-            ):
-                curr_dict_filing = {}
-                curr_dict_filing["input_ids"] = paragraph_features.input_ids
-                curr_dict_filing["input_mask"] = paragraph_features.input_mask
-                curr_dict_filing["segment_ids"] = paragraph_features.segment_ids
-                curr_list_of_paragraphs.append(curr_dict_filing)
-
-            if len(curr_list_of_paragraphs) > longest_list_paragraphs:
-                longest_list_paragraphs = len(curr_list_of_paragraphs)
-
-            self.filings_features.append(
-                [
-                    curr_list_of_paragraphs,
-                    curr_filing_features.list_numerical_kpi_features,
-                    labels_ids[idx_f],
-                ]
-            )
+    def __init__(
+        self,
+        input_ids,
+        input_mask,
+        segment_ids,
+        num_paragraphs,
+        kpi_features,
+        labels_ids,
+    ):
+        # The paragraphs of every filing are already padded with zeros up to the
+        # longest filing, `collate_sec_paragraphs` drops the padding again per batch
+        self.input_ids = input_ids
+        self.input_mask = input_mask
+        self.segment_ids = segment_ids
+        self.num_paragraphs = num_paragraphs
+        self.kpi_features = kpi_features
+        self.labels_ids = labels_ids
 
-        for idx_for_pad, (list_of_paragraphs, _, _) in enumerate(self.filings_features):
-            num_to_pad = longest_list_paragraphs - len(list_of_paragraphs)
-            tensor_to_pad = torch.zeros(max_seq_length, dtype=torch.long)
-            self.filings_features[idx_for_pad][0] = (
-                list_of_paragraphs
-                + [
-                    {
-                        "input_ids": tensor_to_pad,
-                        "input_mask": tensor_to_pad,
-                        "segment_ids": tensor_to_pad,
-                    }
-                ]
-                * num_to_pad
-            )
+    def __len__(self):
+        return len(self.labels_ids)
+
+    def __getitem__(self, index):
+        curr_dict_paragraphs = {
+            "input_ids": self.input_ids[index],
+            "input_mask": self.input_mask[index],
+            "segment_ids": self.segment_ids[index],
+        }
+        return [
+            curr_dict_paragraphs,
+            self.kpi_features[index],
+            self.labels_ids[index],
+            self.num_paragraphs[index],
+        ]
+
+
+def collate_sec_paragraphs(batch):
+    """Collates `SECDataset` items and gathers the real paragraphs of the batch.
+
+    Instead of the zero-padded [batch, paragraphs, seq] tensors, the first element
+    is a single [3, num_paragraphs, max_seq_length] tensor with the input ids, input
+    masks and segment ids of the real paragraphs of all filings, in filing order.
+    """
+    num_paragraphs = torch.stack([item[3] for item in batch])
+    first_input_ids = batch[0][0]["input_ids"]
+    paragraphs = torch.empty(
+        (3, int(num_paragraphs.sum()), first_input_ids.size(-1)),
+        dtype=first_input_ids.dtype,
+    )
+    for idx, key in enumerate(("input_ids", "input_mask", "segment_ids")):
+        torch.cat([item[0][key][: int(item[3])] for item in batch], out=paragraphs[idx])
+
+    return [
+        paragraphs,
+        torch.stack([item[1] for item in batch]),
+        torch.stack([item[2] for item in batch]),
+        num_paragraphs,
+    ]
+
+
+def collate_sec_encoded_paragraphs(batch):
+    """Collates `SECEncodedDataset` items, trimmed to the longest filing of the batch.
+
+    The first element is a contiguous [batch, max_num_paragraphs, hidden] tensor, so
+    the (pinned) batch can be copied to the device asynchronously as a whole.
+    """
+    num_paragraphs = torch.stack([item[3] for item in batch])
+    max_num_paragraphs = int(num_paragraphs.max())
+
+    return [
+        torch.stack([item[0][:max_num_paragraphs] for item in batch]),
+        torch.stack([item[1] for item in batch]),
+        torch.stack([item[2] for item in batch]),
+        num_paragraphs,
+    ]
+
+
+class SECEncodedDataset(Dataset):
+    def __init__(self, encoded_paragraphs, num_paragraphs, kpi_features, labels_ids):
+        # Already encoded paragraphs of every filing, [filings, paragraphs, hidden]
+        self.encoded_paragraphs = encoded_paragraphs
+        self.num_paragraphs = num_paragraphs
+        self.kpi_features = kpi_features
+        self.labels_ids = labels_ids
 
     def __len__(self):
-        return len(self.filings_features)
+        return len(self.labels_ids)
 
     def __getitem__(self, index):
-        # convert to input features filing to dict to be able to pass it in the batch
-        return self.filings_features[index]
+        return [
+            self.encoded_paragraphs[index],
+            self.kpi_features[index],
+            self.labels_ids[index],
+            self.num_paragraphs[index],
+        ]
 
 
 processors = {
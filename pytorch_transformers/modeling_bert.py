@@ -27,6 +27,8 @@ from io import open
 import torch
 from torch import nn
 from torch.nn import CrossEntropyLoss, MSELoss
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .modeling_utils import PreTrainedModel, prune_linear_layer
 from .configuration_bert import BertConfig
@@ -204,6 +206,21 @@ class BertSelfAttention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
+        # Use scaled_dot_product_attention of PyTorch >= 2.0 when the attention probabilities
+        # are neither returned nor masked per head. The attention mask is a dense additive
+        # float mask, which FlashAttention never accepts and the memory efficient kernel only
+        # accepts from PyTorch 2.1; on 2.0 this falls back to the math implementation
+        if hasattr(F, 'scaled_dot_product_attention') and not self.output_attentions and head_mask is None:
+            context_layer = F.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer,
+                attn_mask=attention_mask.to(dtype=query_layer.dtype),
+                dropout_p=self.dropout.p if self.training else 0.0)
+
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+            context_layer = context_layer.view(*new_context_layer_shape)
+            return (context_layer,)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
@@ -333,6 +350,8 @@ class BertEncoder(nn.Module):
         self.output_attentions = config.output_attentions
         self.output_hidden_states = config.output_hidden_states
         self.layer = nn.ModuleList([BertLayer(config) for _ in range(config.num_hidden_layers)])
+        # Recompute the activations of each layer in the backward pass instead of storing them
+        self.gradient_checkpointing = False
 
     def forward(self, hidden_states, attention_mask, head_mask=None):
         all_hidden_states = ()
@@ -341,7 +360,11 @@ class BertEncoder(nn.Module):
             if self.output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
-            layer_outputs = layer_module(hidden_states, attention_mask, head_mask[i])
+            if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+                layer_outputs = checkpoint(layer_module, hidden_states, attention_mask, head_mask[i],
+                                           use_reentrant=True)
+            else:
+                layer_outputs = layer_module(hidden_states, attention_mask, head_mask[i])
             hidden_states = layer_outputs[0]
 
             if self.output_attentions: